@@ -1,8 +1,12 @@
 # Standard library imports
-import json
+import asyncio
+import atexit
 import logging
-from datetime import datetime, timedelta, timezone, time
-from urllib.parse import urlencode
+import re
+from datetime import datetime, timedelta, timezone
+
+# Third-party imports
+import orjson
 
 # Azure imports
 import azure.functions as func
@@ -20,53 +24,101 @@ from msgraph.generated.models.attendee_type import AttendeeType
 from msgraph.generated.models.location import Location
 from msgraph.generated.models.item_body import ItemBody
 from msgraph.generated.models.body_type import BodyType
+from msgraph.generated.users.item.calendar_view.calendar_view_request_builder import CalendarViewRequestBuilder
+
+# MCP ツールのプロパティ定義（import 時に一度だけシリアライズ）
+_GET_EVENTS_PROPS = orjson.dumps([
+    {
+        "propertyName": "userPrincipalName",
+        "propertyType": "string",
+        "description": "予定を取得したいユーザーのUPN（例: user@example.com）",
+        "required": True
+    }
+]).decode()
+
+# ★ 重要：トップレベルは「配列」＋ JSON 文字列！
+_CREATE_EVENT_PROPS = orjson.dumps([
+    {"propertyName": "userPrincipalName", "propertyType": "string",  "required": True},
+    {"propertyName": "subject",           "propertyType": "string",  "required": True},
+    {"propertyName": "start",             "propertyType": "string",  "required": True},
+    {"propertyName": "end",               "propertyType": "string",  "required": True},
+    # ★ 暫定：array ではなく string（CSV/セミコロン対応）
+    {"propertyName": "attendees",         "propertyType": "string",  "required": False},
+    {"propertyName": "isOnlineMeeting",   "propertyType": "boolean", "required": False},
+    {"propertyName": "location",          "propertyType": "string",  "required": False},
+    {"propertyName": "body",              "propertyType": "string",  "required": False}
+]).decode()
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+logger = logging.getLogger(__name__)
+
 # 固定オフセット（日本はDSTなし）
 JST = timezone(timedelta(hours=9))
 
+# BodyType は SDK のバージョン差対策（PascalCase 版が無ければ文字列にフォールバック）
+try:
+    _BODY_HTML, _BODY_TEXT = BodyType.Html, BodyType.Text
+except AttributeError:
+    _BODY_HTML, _BODY_TEXT = "html", "text"
+
+# _to_bool で真とみなす文字列
+_TRUTHY = frozenset({"true", "1", "yes", "y", "on"})
+
+# 参加者文字列の区切り（カンマ/セミコロン）
+_ATTENDEE_SEP = re.compile(r"[,;]")
+
+# リクエスト設定は毎回同一のため使い回す（SDK は送信時にヘッダーを複製し、元の設定は変更しない）
+# 取得：Prefer で返却の start/end を JST 表示に（初回ページはクエリパラメータと組み合わせて使用）
+_GET_HEADERS = HeadersCollection()
+_GET_HEADERS.add("Prefer", 'outlook.timezone="Tokyo Standard Time"')
+_GET_REQ_CFG = RequestConfiguration(headers=_GET_HEADERS)
+
+# 作成：Prefer: representation + JST 表示
+_CREATE_HEADERS = HeadersCollection()
+_CREATE_HEADERS.add("Prefer", 'return=representation')
+_CREATE_HEADERS.add("Prefer", 'outlook.timezone="Tokyo Standard Time"')
+_CREATE_REQ_CFG = RequestConfiguration(headers=_CREATE_HEADERS)
+
+# 資格情報と Graph クライアントはワーカープロセス内で使い回す（トークンキャッシュ・接続プールを再利用）
+_credential = DefaultAzureCredential()
+_client = GraphServiceClient(
+    # あなたの環境は複数形の 'credentials' が正（単数 'credential' はNG）
+    credentials=_credential,
+    scopes=["https://graph.microsoft.com/.default"]
+)
+
+@atexit.register
+def _close_credential():
+    """ワーカー終了時に資格情報（内部の HTTP セッション）を閉じる"""
+    try:
+        asyncio.run(_credential.close())
+    except Exception:
+        logger.warning("Failed to close DefaultAzureCredential on shutdown", exc_info=True)
+
 # 整形に使用するへヘルパー関数群
 def _dtz_to_str(dtz):
-    """Graph の DateTimeTimeZone から ISO 文字列のみを返す（例: '2025-09-17T09:00:00'）"""
-    if not dtz:
-        return None
-    # 属性名の揺れ（date_time / dateTime）を吸収
-    dt = getattr(dtz, "date_time", getattr(dtz, "dateTime", None))
-    # datetime 型なら ISO に
-    if hasattr(dt, "isoformat"):
-        return dt.isoformat()
-    # 既に str の場合想定
-    return dt
+    """Graph の DateTimeTimeZone から日時のみを返す（例: '2025-09-17T09:00:00'、datetime 型は orjson が ISO 化）"""
+    return dtz.date_time if dtz else None
 
 def _event_to_min_dict(ev):
-    """LLM 用に最小項目のみ抽出"""
+    """LLM 用に最小項目のみ抽出（msgraph SDK のモデルは snake_case 属性のみ）"""
     return {
-        "subject": getattr(ev, "subject", None),
-        "start": _dtz_to_str(getattr(ev, "start", None)),
-        "end": _dtz_to_str(getattr(ev, "end", None)),
-        "isAllDay": getattr(ev, "is_all_day", getattr(ev, "isAllDay", None)),
+        "subject": ev.subject,
+        "start": _dtz_to_str(ev.start),
+        "end": _dtz_to_str(ev.end),
+        "isAllDay": ev.is_all_day,
     }
 
-def _parse_to_jst(dt_str: str):
-    """ISO文字列を datetime へ。オフセット無ければ JST を付与。"""
-    if not dt_str:
-        return None
-    try:
-        dt = datetime.fromisoformat(dt_str)
-    except Exception:
-        try:
-            dt = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S")
-        except Exception:
-            return None
-    # タイムゾーン情報が無ければ JST を付与（Prefer:outlook.timezone でローカル返却想定）
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=JST)
-    return dt
+def _to_local(dt: str) -> str:
+    """オフセット（+09:00 / Z）を除いたローカル時刻文字列を返す。オフセット無しならそのまま"""
+    if "+" not in dt and "Z" not in dt:
+        return dt
+    return dt.partition("+")[0].partition("Z")[0]
 
 def _to_bool(v, default=False):
-    if isinstance(v, bool): return v
-    if isinstance(v, str):  return v.strip().lower() in ("true","1","yes","y","on")
+    if v is True or v is False: return v
+    if isinstance(v, str):  return v.strip().lower() in _TRUTHY
     if isinstance(v, (int, float)): return bool(v)
     return default
 
@@ -75,107 +127,68 @@ def _to_bool(v, default=False):
     type="mcpToolTrigger",
     toolName="get_user_outlook_events",
     description="指定したユーザーのOutlook予定を取得します。",
-    toolProperties=json.dumps([
-        {
-            "propertyName": "userPrincipalName",
-            "propertyType": "string",
-            "description": "予定を取得したいユーザーのUPN（例: user@example.com）",
-            "required": True
-        }
-    ]),
+    toolProperties=_GET_EVENTS_PROPS,
 )
 async def get_user_outlook_events(context) -> str:
     try:
-        content = json.loads(context)
+        content = orjson.loads(context)
         upn = content["arguments"].get("userPrincipalName")
         if not upn:
-            return json.dumps({"error": "userPrincipalName is required."}, ensure_ascii=False)
+            return orjson.dumps({"error": "userPrincipalName is required."}).decode()
 
         # JST の「明日 00:00」
         now_jst = datetime.now(JST)
-        tomorrow_start_jst = datetime.combine(
-            now_jst.date() + timedelta(days=1), time(0, 0, 0), tzinfo=JST
+        tomorrow_start_jst = now_jst.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+        # 期間：明日 00:00（JST）〜 30日後（必要に応じて調整）
+        start = tomorrow_start_jst.isoformat()                         # 例: 2025-10-07T00:00:00+09:00
+        end   = (tomorrow_start_jst + timedelta(days=30)).isoformat()  # 例: 2025-11-06T00:00:00+09:00
+
+        # クエリは SDK のクエリパラメータで指定（エンコードは SDK 側で実施、'+' は '%2B' に）
+        # $top は calendarView の上限 1000（往復回数を最小化）
+        query = CalendarViewRequestBuilder.CalendarViewRequestBuilderGetQueryParameters(
+            start_date_time=start,
+            end_date_time=end,
+            select=["subject", "start", "end", "isAllDay"],
+            orderby=["start/dateTime asc"],
+            top=1000,
         )
-
-        async with DefaultAzureCredential() as credential:
-            client = GraphServiceClient(
-                # あなたの環境は複数形の 'credentials' が正（単数 'credential' はNG）
-                credentials=credential,
-                scopes=["https://graph.microsoft.com/.default"]
-            )
-
-            # 期間：明日 00:00（JST）〜 30日後（必要に応じて調整）
-            start = tomorrow_start_jst.isoformat()                         # 例: 2025-10-07T00:00:00+09:00
-            end   = (tomorrow_start_jst + timedelta(days=30)).isoformat()  # 例: 2025-11-06T00:00:00+09:00
-
-            # クエリは urlencode で正しくエンコード（'+' を '%2B' に）
-            params = {
-                "startDateTime": start,
-                "endDateTime": end,
-                "$select": "subject,start,end,isAllDay",
-                "$orderby": "start/dateTime asc",
-                "$top": "100",  # calendarView の $top は 1〜1000
-            }
-            cv_url = f"https://graph.microsoft.com/v1.0/users/{upn}/calendarView?{urlencode(params)}"
-
-            # RequestBuilder を生URLで差し替え
-            cv_builder = client.users.by_user_id(upn).calendar_view.with_url(cv_url)
-
-            # Prefer で返却の start/end を JST 表示に
-            headers = HeadersCollection()
-            headers.add("Prefer", 'outlook.timezone="Tokyo Standard Time"')
-            req = RequestConfiguration(headers=headers)
-
-            # 期間内の「各回（occurrences / exceptions）」が展開されて返る
-            resp = await cv_builder.get(request_configuration=req)
-
-            # 最小項目へ整形
-            items = []
-            if resp and getattr(resp, "value", None):
-                for ev in resp.value:
-                    items.append(_event_to_min_dict(ev))
-
-            # （保険）アプリ側でも明日以降に絞る
-            filtered = []
-            for it in items:
-                sd = _parse_to_jst(it.get("start"))
-                if sd and sd >= tomorrow_start_jst:
-                    filtered.append(it)
-
-            # （保険）開始時刻で昇順ソート
-            filtered.sort(key=lambda it: _parse_to_jst(it.get("start")) or datetime.max.replace(tzinfo=JST))
-
-            result = {
-                "user": {"userPrincipalName": upn},
-                "value": filtered
-            }
-            return json.dumps(result, ensure_ascii=False, indent=2)
+        req = RequestConfiguration(headers=_GET_HEADERS, query_parameters=query)
+        cv_builder = _client.users.by_user_id(upn).calendar_view
+
+        # 期間内の「各回（occurrences / exceptions）」が展開されて返る
+        # 期間・並び順は calendarView の startDateTime / $orderby で保証されるため、ページごとに最小項目へ整形するのみ
+        # （SDK の Event オブジェクトをページを跨いで保持しない）
+        resp = await cv_builder.get(request_configuration=req)
+        items = [_event_to_min_dict(ev) for ev in resp.value] if resp and resp.value else []
+
+        # 1000件を超える場合は @odata.nextLink を辿って残りのページも取得
+        # （nextLink は前ページの応答にしか含まれないため、ページ取得は逐次。クエリは nextLink に含まれる）
+        while resp and resp.odata_next_link:
+            resp = await cv_builder.with_url(resp.odata_next_link).get(request_configuration=_GET_REQ_CFG)
+            if resp and resp.value:
+                items.extend([_event_to_min_dict(ev) for ev in resp.value])
+
+        result = {
+            "user": {"userPrincipalName": upn},
+            "value": items
+        }
+        return orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
 
     except Exception as e:
-        logging.exception("Error retrieving events")
-        return json.dumps({"error": str(e)}, ensure_ascii=False)
+        logger.exception("Error retrieving events")
+        return orjson.dumps({"error": str(e)}).decode()
 
 @app.generic_trigger(
     arg_name="context",
     type="mcpToolTrigger",
     toolName="create_simple_event",
     description="指定ユーザーのOutlookに簡易予定を作成（全員必須参加者・Teams対応・場所/本文対応）。",
-    # ★ 重要：トップレベルは「配列」＋ json.dumps！
-    toolProperties=json.dumps([
-        {"propertyName": "userPrincipalName", "propertyType": "string",  "required": True},
-        {"propertyName": "subject",           "propertyType": "string",  "required": True},
-        {"propertyName": "start",             "propertyType": "string",  "required": True},
-        {"propertyName": "end",               "propertyType": "string",  "required": True},
-        # ★ 暫定：array ではなく string（CSV/セミコロン対応）
-        {"propertyName": "attendees",         "propertyType": "string",  "required": False},
-        {"propertyName": "isOnlineMeeting",   "propertyType": "boolean", "required": False},
-        {"propertyName": "location",          "propertyType": "string",  "required": False},
-        {"propertyName": "body",              "propertyType": "string",  "required": False}
-    ]),
+    toolProperties=_CREATE_EVENT_PROPS,
 )
 async def create_simple_event(context) -> str:
     try:
-        args = json.loads(context).get("arguments", {})
+        args = orjson.loads(context).get("arguments", {})
         upn = args.get("userPrincipalName")
         subject = args.get("subject")
         start_str = args.get("start")
@@ -187,23 +200,28 @@ async def create_simple_event(context) -> str:
         body_str = args.get("body")
 
         if not all([upn, subject, start_str, end_str]):
-            return json.dumps({"error": "必須項目が不足しています"}, ensure_ascii=False)
+            return orjson.dumps({"error": "必須項目が不足しています"}).decode()
 
         # 時刻は「ローカル時刻（オフセット無し）＋Tokyo Standard Time」
-        def _to_local(dt: str) -> str:
-            return dt.split("+")[0].split("Z")[0]
-
         start_dttz = DateTimeTimeZone(date_time=_to_local(start_str), time_zone="Tokyo Standard Time")
         end_dttz   = DateTimeTimeZone(date_time=_to_local(end_str),   time_zone="Tokyo Standard Time")
 
         # 参加者（全員必須）：配列 or 文字列（カンマ/セミコロン区切り）
         if isinstance(raw_attendees, list):
-            emails = [e.strip() for e in raw_attendees if isinstance(e, str)]
+            tokens = [e for e in raw_attendees if isinstance(e, str)]
         elif isinstance(raw_attendees, str):
-            emails = [t.strip() for t in raw_attendees.replace(";", ",").split(",") if t.strip()]
+            tokens = _ATTENDEE_SEP.split(raw_attendees)
         else:
-            emails = []
-        emails = list(dict.fromkeys([e for e in emails if "@" in e]))  # 重複除去＆簡易バリデーション
+            tokens = []
+        # strip・簡易バリデーション（'@' が先頭/末尾でない）・重複除去（順序維持）を1パスで
+        seen = set()
+        emails = []
+        for t in tokens:
+            e = t.strip()
+            at = e.find("@")
+            if 0 < at < len(e) - 1 and e not in seen:
+                seen.add(e)
+                emails.append(e)
 
         attendees = [
             Attendee(email_address=EmailAddress(address=e), type="required")  # ← 文字列で安全に
@@ -213,10 +231,7 @@ async def create_simple_event(context) -> str:
         # 場所・本文（BodyType は環境差対策付き）
         ev_location = Location(display_name=location_str) if location_str else None
         if body_str:
-            try:
-                ct = BodyType.Html if ("<" in body_str) else BodyType.Text  # PascalCase 版
-            except AttributeError:
-                ct = "html" if ("<" in body_str) else "text"               # 文字列フォールバック
+            ct = _BODY_HTML if "<" in body_str else _BODY_TEXT
             ev_body = ItemBody(content=body_str, content_type=ct)
         else:
             ev_body = None
@@ -233,17 +248,9 @@ async def create_simple_event(context) -> str:
             # online_meeting_provider は渡さない
         )
 
-        # Prefer: representation + JST 表示
-        headers = HeadersCollection()
-        headers.add("Prefer", 'return=representation')
-        headers.add("Prefer", 'outlook.timezone="Tokyo Standard Time"')
-        req = RequestConfiguration(headers=headers)
-
-        async with DefaultAzureCredential() as credential:
-            client = GraphServiceClient(credentials=credential, scopes=["https://graph.microsoft.com/.default"])
-            created = await client.users.by_user_id(upn).events.post(ev, request_configuration=req)
+        created = await _client.users.by_user_id(upn).events.post(ev, request_configuration=_CREATE_REQ_CFG)
 
-        return json.dumps({
+        return orjson.dumps({
             "created": {
                 "id": getattr(created, "id", None),
                 "subject": getattr(created, "subject", None),
@@ -257,7 +264,7 @@ async def create_simple_event(context) -> str:
                 "location": getattr(getattr(created, "location", None), "display_name", None),
                 "isOnlineMeeting": getattr(created, "is_online_meeting", None)
             }
-        }, ensure_ascii=False, indent=2)
+        }, option=orjson.OPT_INDENT_2).decode()
 
     except Exception as e:
-        logging.exception("Error creating simple event")
\ No newline at end of file
+        logger.exception("Error creating simple event")
\ No newline at end of file